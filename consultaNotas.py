@@ -1,11 +1,18 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
 from google.oauth2.service_account import Credentials
 import re
 import traceback
 import os
 import json
+import tempfile
+import threading
+import time
+import random
+import logging
 
 # Constantes
 SCOPE = [
@@ -14,10 +21,42 @@ SCOPE = [
 ]
 SHEET_NAME = "Boletins"
 WORKSHEET_NOTAS = "Notas_Tabela"
+REQUIRED_COLS = ['Série', 'Nome do Aluno', 'Matrícula',
+                 'Bimestre', 'Componente Curricular', 'Tipo de Avaliação', 'Nota']
+# Última coluna lida: A:H vai de 'Nome do Aluno' até 'Nota' no layout gravado por lancamentoNotas
+ULTIMA_COLUNA = "H"
+# Cópia local (Parquet) dos dados já normalizados; cada app normaliza de um jeito,
+# então cada um usa o próprio subdiretório
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache",
+                         os.path.splitext(os.path.basename(__file__))[0])
+
+logger = logging.getLogger(__name__)
+
+# Padrões usados na limpeza das notas
+DATE_RE = re.compile(r'^\d{1,2}/\d{1,2}$')
+NON_NUMERIC_RE = re.compile(r'[^\d.]')
 
 # Funções auxiliares
 
 
+def show_error(message):
+    """Exibe o erro; o traceback completo só aparece com DEBUG ativo na sessão."""
+    if st.session_state.get("DEBUG"):
+        message = f"{message}\n{traceback.format_exc()}"
+    st.error(message)
+
+
+def with_retry(fn, *args, retries=5, base=0.5, **kwargs):
+    """Chama a API do Google repetindo com backoff exponencial em erros de cota ou do servidor."""
+    for tentativa in range(retries):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in (429, 500, 503) or tentativa == retries - 1:
+                raise
+            time.sleep(base * 2 ** tentativa + random.random() * 0.1)
+
+
 def authenticate_gsheets():
     """Autentica com Google Sheets usando credenciais JSON."""
     try:
@@ -47,109 +86,284 @@ def authenticate_gsheets():
             f"Erro ao ler o arquivo credenciais.json: Formato JSON inválido. {e}")
         st.stop()
     except Exception as e:
-        st.error(
-            f"Erro ao autenticar com Google Sheets: {e}\n{traceback.format_exc()}")
+        show_error(
+            f"Erro ao autenticar com Google Sheets: {e}")
         st.stop()
 
 
-def clean_nota_value(value):
-    """Converte valores de nota, tratando vírgulas, datas e outros formatos."""
-    if pd.isna(value):
-        return 0.0
-    value = str(value).strip()
-    value = value.replace(',', '.')
-    if re.match(r'^\d{1,2}/\d{1,2}$', value):
+def clean_nota_series(notas):
+    """Converte uma coluna de notas, tratando vírgulas, datas e outros formatos."""
+    s = notas.astype(str).str.strip().str.replace(',', '.', regex=False)
+    date_mask = s.str.fullmatch(DATE_RE)
+    s = s.mask(date_mask, s.str.replace('/', '.', regex=False))
+    s = s.str.replace(NON_NUMERIC_RE, '', regex=True)
+    # Mantém apenas o primeiro ponto decimal
+    partes = s.str.partition('.')
+    s = partes[0] + partes[1] + partes[2].str.replace('.', '', regex=False)
+    return pd.to_numeric(s, errors='coerce').fillna(0.0)
+
+
+def rows_to_dataframe(rows):
+    """Monta um DataFrame a partir das linhas da planilha (cabeçalho na primeira linha)."""
+    if not rows:
+        return pd.DataFrame()
+    # Cabeçalhos vazios ou repetidos recebem nomes únicos
+    headers = []
+    vistos = {}
+    for i, col in enumerate(rows[0]):
+        col = col or f"Coluna_{i + 1}"
+        if col in vistos:
+            vistos[col] += 1
+            col = f"{col}_{vistos[col]}"
+        else:
+            vistos[col] = 1
+        headers.append(col)
+    # A API de valores omite células vazias no fim da linha (inclusive no
+    # cabeçalho); ajusta cada linha exatamente à largura do cabeçalho
+    largura = len(headers)
+    linhas = [(list(row) + [''] * largura)[:largura] for row in rows[1:]]
+    return pd.DataFrame(linhas, columns=headers)
+
+
+def get_sheet_revision(spreadsheet):
+    """Retorna a data da última alteração da planilha no Drive (None se indisponível)."""
+    try:
+        resp = spreadsheet.client.request(
+            "get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet.id}",
+            params={"fields": "modifiedTime", "supportsAllDrives": True})
+        return resp.json().get("modifiedTime")
+    except Exception:
+        return None
+
+
+def read_parquet_cache(name, revision):
+    """Lê a cópia local do DataFrame se ela corresponde à revisão da planilha."""
+    if revision is None:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, f"{name}.meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("revision") != revision:
+            return None
+        return pd.read_parquet(os.path.join(CACHE_DIR, f"{name}.parquet"))
+    except (OSError, ValueError, ImportError):
+        return None
+
+
+def replace_file(path, write):
+    """Grava via write(caminho_temporario) e move o resultado para path de uma só vez."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except Exception:
         try:
-            parts = value.split('/')
-            value = f"{parts[0]}.{parts[1]}"
-        except:
-            return 0.0
-    value = re.sub(r'[^\d.]', '', value)
-    parts = value.split('.')
-    if len(parts) > 2:
-        value = parts[0] + '.' + ''.join(parts[1:])
-    return float(value) if value else 0.0
-
-
-@st.cache_data(show_spinner=False, ttl=300)
-def load_data(worksheet_name, _cache_version=0):
-    """Carrega dados da planilha."""
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def write_parquet_cache(name, revision, df):
+    """Salva a cópia local do DataFrame associada à revisão da planilha."""
+    if revision is None:
+        return
     try:
-        client = st.session_state["client"]
-        sheet = client.open(SHEET_NAME).worksheet(worksheet_name)
-        df = pd.DataFrame(sheet.get_all_records())
-        if df.empty:
-            st.error("Planilha vazia.")
-            st.stop()
-        required_cols = ['Série', 'Nome do Aluno', 'Matrícula',
-                         'Bimestre', 'Componente Curricular', 'Tipo de Avaliação', 'Nota']
-        if not all(col in df.columns for col in required_cols):
-            st.error("Colunas obrigatórias ausentes na planilha.")
-            st.stop()
-        # Normalizar colunas de texto
-        for col in required_cols[:-1]:  # Exceto 'Nota'
-            df[col] = df[col].astype(str).str.strip().str.upper()
-        df['Nota'] = df['Nota'].apply(clean_nota_value)
-        return df
-    except gspread.exceptions.WorksheetNotFound:
-        st.error(f"Planilha {worksheet_name} não encontrada.")
-        st.stop()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Parquet primeiro e metadados por último: um leitor concorrente nunca
+        # vê a revisão nova apontando para um arquivo incompleto
+        replace_file(os.path.join(CACHE_DIR, f"{name}.parquet"),
+                     lambda tmp: df.to_parquet(tmp, index=False))
+
+        def write_meta(tmp):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"revision": revision}, f)
+
+        replace_file(os.path.join(CACHE_DIR, f"{name}.meta.json"), write_meta)
+    except (OSError, ValueError, ImportError):
+        pass
+
+
+def normalize_notas(df):
+    """Normaliza as colunas de texto e converte a coluna 'Nota'."""
+    for col in REQUIRED_COLS[:-1]:  # Exceto 'Nota'
+        df[col] = df[col].astype(str).str.strip().str.upper()
+    df['Nota'] = clean_nota_series(df['Nota'])
+    return df
+
+
+def open_spreadsheet(client):
+    """Abre a planilha principal uma única vez."""
+    try:
+        return client.open(SHEET_NAME)
     except Exception as e:
-        st.error(f"Erro ao acessar planilha: {e}\n{traceback.format_exc()}")
-        st.stopped()
+        show_error(f"Erro ao acessar planilha: {e}")
+        st.stop()
+
+
+def load_data(spreadsheet, worksheet_name, revision=None):
+    """Carrega dados da planilha, reaproveitando a cópia local se ela não mudou.
+
+    Não usa st.*, pois também roda na thread de atualização em segundo plano;
+    erros são propagados para quem chamou.
+    """
+    df = read_parquet_cache(worksheet_name, revision)
+    if df is not None:
+        return df
+    sheet = with_retry(spreadsheet.worksheet, worksheet_name)
+    df = rows_to_dataframe(with_retry(sheet.get, f"A1:{ULTIMA_COLUNA}"))
+    if df.empty:
+        raise ValueError("Planilha vazia.")
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        raise ValueError("Colunas obrigatórias ausentes na planilha.")
+    df = normalize_notas(df[REQUIRED_COLS].copy())
+    # Adiciona índice da linha (1-based, considerando cabeçalho)
+    df['row_index'] = df.index + 2
+    write_parquet_cache(worksheet_name, revision, df)
+    return df
+
+
+def fetch_notas(spreadsheet):
+    """Verifica a revisão da planilha e carrega as notas."""
+    return load_data(spreadsheet, WORKSHEET_NOTAS, revision=get_sheet_revision(spreadsheet))
+
+
+@st.cache_resource
+def get_refresh_store():
+    """Guarda, entre reruns e sessões, os valores servidos por refreshable_cache."""
+    return {"values": {}, "refreshing": set(), "lock": threading.Lock()}
 
 
-def validate_matricula(nome, matricula, alunos_serie):
+def refreshable_cache(key, ttl, fn, *args):
+    """Retorna fn(*args) em cache sob key; após o ttl, serve o valor antigo e atualiza em segundo plano."""
+    store = get_refresh_store()
+
+    def refresh():
+        # Sem ScriptRunContext aqui: nada de st.*; em caso de erro, mantém o valor
+        # antigo e só tenta de novo após outro ttl
+        try:
+            value = fn(*args)
+        except Exception:
+            logger.exception("Falha ao atualizar %s em segundo plano", key)
+            value = None
+        with store["lock"]:
+            if value is None:
+                value = store["values"][key][0]
+            store["values"][key] = (value, time.monotonic() + ttl)
+            store["refreshing"].discard(key)
+
+    with store["lock"]:
+        entry = store["values"].get(key)
+        if entry is not None:
+            value, expiry = entry
+            if time.monotonic() >= expiry and key not in store["refreshing"]:
+                store["refreshing"].add(key)
+                threading.Thread(target=refresh, daemon=True).start()
+            return value
+
+    # Primeira carga no processo: busca de forma síncrona
+    value = fn(*args)
+    with store["lock"]:
+        store["values"][key] = (value, time.monotonic() + ttl)
+    return value
+
+
+def get_notas_row_count(spreadsheet):
+    """Quantidade atual de linhas da aba de notas (a grade cresce a cada lançamento)."""
+    return with_retry(spreadsheet.worksheet, WORKSHEET_NOTAS).row_count
+
+
+def fetch_student_rows(spreadsheet, df, linhas, row_count):
+    """Relê na planilha só as linhas indicadas e as incluídas após a última carga.
+
+    row_count limita o intervalo final: ler além da grade da aba é erro na API.
+    """
+    # Cabeçalho primeiro, depois as linhas consecutivas agrupadas em um único intervalo A1
+    ranges = [f"A1:{ULTIMA_COLUNA}1"]
+    inicio = fim = None
+    for linha in sorted(linhas):
+        if fim is not None and linha == fim + 1:
+            fim = linha
+            continue
+        if inicio is not None:
+            ranges.append(f"A{inicio}:{ULTIMA_COLUNA}{fim}")
+        inicio = fim = linha
+    if inicio is not None:
+        ranges.append(f"A{inicio}:{ULTIMA_COLUNA}{fim}")
+    if len(df) + 2 <= row_count:
+        ranges.append(f"A{len(df) + 2}:{ULTIMA_COLUNA}{row_count}")
+    resp = with_retry(spreadsheet.values_batch_get,
+                      [f"{WORKSHEET_NOTAS}!{r}" for r in ranges])
+    rows = [row for value_range in resp.get('valueRanges', [])
+            for row in value_range.get('values', []) if row]
+    return normalize_notas(rows_to_dataframe(rows)[REQUIRED_COLS].copy())
+
+
+def sorted_unique(values):
+    """Valores distintos e ordenados de uma coluna, prontos para um selectbox."""
+    return np.sort(values.dropna().unique()).tolist()
+
+
+def cached_options(df, key, compute):
+    """Memoriza na sessão listas de opções derivadas de df até que df seja recarregado."""
+    cache = st.session_state.setdefault(
+        "options_cache", {"df": None, "values": {}})
+    # Guarda a referência (e não o id) para que um novo df nunca reaproveite o cache
+    if cache["df"] is not df:
+        cache["df"] = df
+        cache["values"] = {}
+    if key not in cache["values"]:
+        cache["values"][key] = compute()
+    return cache["values"][key]
+
+
+def get_alunos_for_serie(df, serie):
+    """Alunos (nome e matrícula) de uma série, memorizados até o df ser recarregado."""
+    return cached_options(df, ("alunos", serie), lambda: df[df["Série"] == serie][[
+        "Nome do Aluno", "Matrícula"]].drop_duplicates())
+
+
+def get_nomes(df, serie):
+    """Nomes dos alunos de uma série, em ordem alfabética."""
+    return cached_options(df, ("nomes", serie), lambda: sorted_unique(
+        get_alunos_for_serie(df, serie)["Nome do Aluno"]))
+
+
+def get_bimestres(df, nome):
+    """Bimestres com notas lançadas para um aluno."""
+    return cached_options(df, ("bimestres", nome), lambda: sorted_unique(
+        df[df["Nome do Aluno"] == nome]["Bimestre"]))
+
+
+def get_matricula_set(df):
+    """Conjunto de pares (nome, matrícula) válidos, memorizado até o df ser recarregado."""
+    return cached_options(df, "matriculas", lambda: set(
+        zip(df['Nome do Aluno'], df['Matrícula'])))
+
+
+def validate_matricula(nome, matricula, matricula_set):
     """Valida a matrícula do aluno."""
-    return not alunos_serie[
-        (alunos_serie['Nome do Aluno'].str.upper() == nome.upper()) &
-        (alunos_serie['Matrícula'].astype(
-            str).str.strip() == matricula.strip())
-    ].empty
-
-
-def calculate_media(resultado):
-    """Calcula a média entre MENSAL e BIMESTRAL para cada componente curricular."""
-    medias = {}
-    mensal_rows = resultado[resultado['Tipo de Avaliação'] == 'MENSAL']
-    bimestral_rows = resultado[resultado['Tipo de Avaliação'] == 'BIMESTRAL']
-
-    for comp in resultado['Componente Curricular'].unique():
-        mensal = mensal_rows[mensal_rows['Componente Curricular'] ==
-                             comp]['Nota'].iloc[0] if not mensal_rows[mensal_rows['Componente Curricular'] == comp].empty else 0.0
-        bimestral = bimestral_rows[bimestral_rows['Componente Curricular'] ==
-                                   comp]['Nota'].iloc[0] if not bimestral_rows[bimestral_rows['Componente Curricular'] == comp].empty else 0.0
-        if mensal > 0.0 or bimestral > 0.0:
-            medias[comp] = (mensal + bimestral) / 2
-        else:
-            medias[comp] = 0.0
-    return medias
+    # Colunas já normalizadas em load_data; normaliza só a entrada
+    return (nome.strip().upper(), matricula.strip().upper()) in matricula_set
 
 
-def check_recuperacao(medias):
+def check_recuperacao(boletim):
     """Verifica se recuperação é necessária para médias < 8."""
-    recuperacao_needed = []
-    for comp, media in medias.items():
-        if media < 8:
-            recuperacao_needed.append(f"{comp} (Média: {media:.2f})")
-    return recuperacao_needed
+    abaixo = boletim.loc[boletim['Med'] < 8, ['Componente Curricular', 'Med']]
+    return [f"{comp} (Média: {media:.2f})"
+            for comp, media in abaixo.itertuples(index=False)]
 
 
-def check_recuperacao_final(resultado, medias):
+def check_recuperacao_final(boletim):
     """Verifica o resultado da recuperação apenas para componentes com média < 8."""
-    recuperacao_rows = resultado[resultado['Tipo de Avaliação']
-                                 == 'RECUPERAÇÃO']
-    resultados = []
-    # Considera apenas componentes que precisaram de recuperação precisa
-    componentes_recuperacao = [comp for comp,
-                               media in medias.items() if media < 8]
-    for comp in componentes_recuperacao:
-        nota_rec = recuperacao_rows[recuperacao_rows['Componente Curricular'] ==
-                                    comp]['Nota'].iloc[0] if not recuperacao_rows[recuperacao_rows['Componente Curricular'] == comp].empty else 0.0
-        status = "Aprovado" if nota_rec >= 8 else "Reprovado"
-        resultados.append(
-            f"{comp} (Nota de Recuperação: {nota_rec:.2f} - {status})")
-    return resultados
+    abaixo = boletim.loc[boletim['Med'] < 8]
+    notas_rec = abaixo['Rec'].fillna(
+        0.0) if 'Rec' in abaixo else pd.Series(0.0, index=abaixo.index)
+    return [
+        f"{comp} (Nota de Recuperação: {nota_rec:.2f} - {'Aprovado' if nota_rec >= 8 else 'Reprovado'})"
+        for comp, nota_rec in zip(abaixo['Componente Curricular'], notas_rec)
+    ]
 
 
 def display_boletim(resultado):
@@ -178,10 +392,11 @@ def display_boletim(resultado):
         "RECUPERAÇÃO FINAL": "Rec Final"
     })
 
-    # Calcular médias
-    medias = calculate_media(resultado)
-    boletim['Med'] = [medias.get(comp, 0.0)
-                      for comp in boletim['Componente Curricular']]
+    # Calcular médias a partir do próprio boletim
+    sem_nota = pd.Series(0.0, index=boletim.index)
+    men = boletim.get('Men', sem_nota).fillna(0.0)
+    bim = boletim.get('Bim', sem_nota).fillna(0.0)
+    boletim['Med'] = np.where((men > 0) | (bim > 0), (men + bim) / 2, 0.0)
 
     def colorir_nota(val):
         if isinstance(val, (int, float)):
@@ -196,7 +411,7 @@ def display_boletim(resultado):
     )
 
     # Mensagens de recuperação necessária
-    recuperacao_needed = check_recuperacao(medias)
+    recuperacao_needed = check_recuperacao(boletim)
     if recuperacao_needed:
         st.warning("Recuperação necessária para: " +
                    ", ".join(recuperacao_needed))
@@ -204,7 +419,7 @@ def display_boletim(resultado):
                    ", ".join([comp.split(" (")[0] for comp in recuperacao_needed]))
 
     # Mensagens de resultado da recuperação
-    recuperacao_resultados = check_recuperacao_final(resultado, medias)
+    recuperacao_resultados = check_recuperacao_final(boletim)
     if recuperacao_resultados:
         st.info("Resultado da recuperação: " +
                 ", ".join(recuperacao_resultados))
@@ -213,12 +428,23 @@ def display_boletim(resultado):
 # Inicialização
 if "client" not in st.session_state:
     st.session_state["client"] = authenticate_gsheets()
-if "cache_version" not in st.session_state:
-    st.session_state["cache_version"] = 0
-
-# Carregar dados
-df = load_data(WORKSHEET_NOTAS,
-               _cache_version=st.session_state["cache_version"])
+if "spreadsheet" not in st.session_state:
+    st.session_state["spreadsheet"] = open_spreadsheet(
+        st.session_state["client"])
+
+# Carregar dados (após 5 minutos, a atualização ocorre em segundo plano)
+try:
+    df = refreshable_cache(WORKSHEET_NOTAS, 300,
+                           fetch_notas, st.session_state["spreadsheet"])
+except gspread.exceptions.WorksheetNotFound:
+    st.error(f"Planilha {WORKSHEET_NOTAS} não encontrada.")
+    st.stop()
+except ValueError as e:
+    st.error(str(e))
+    st.stop()
+except Exception as e:
+    show_error(f"Erro ao acessar planilha: {e}")
+    st.stop()
 
 # Título
 st.title("Consulta de Notas 2025")
@@ -226,28 +452,24 @@ st.title("Consulta de Notas 2025")
 # Botão de nova consulta
 if "consultado" in st.session_state and st.button("Nova consulta"):
     for key in list(st.session_state.keys()):
-        if key not in ["client", "cache_version"]:
+        if key not in ["client", "spreadsheet"]:
             del st.session_state[key]
-    st.session_state["cache_version"] += 1
     st.rerun()
 
 # 1️⃣ Selecionar Série
-series = sorted(df["Série"].dropna().unique().tolist())
+series = cached_options(df, "series", lambda: sorted_unique(df["Série"]))
 serie_selecionada = st.selectbox(
     "Selecione a série:", [""] + series, key="serie")
 
 # 2️⃣ Selecionar Aluno
 if serie_selecionada:
-    alunos_serie = df[df["Série"] == serie_selecionada][[
-        "Nome do Aluno", "Matrícula"]].drop_duplicates()
-    nomes = sorted(alunos_serie["Nome do Aluno"].tolist())
+    nomes = get_nomes(df, serie_selecionada)
     nome_selecionado = st.selectbox(
         "Selecione o aluno:", [""] + nomes, key="nome")
 
     # 3️⃣ Selecionar Bimestre
     if nome_selecionado:
-        bimestres = sorted(df[df["Nome do Aluno"] == nome_selecionado]
-                           ["Bimestre"].dropna().unique().tolist())
+        bimestres = get_bimestres(df, nome_selecionado)
         bimestre = st.selectbox(
             "Selecione o bimestre/período:", [""] + bimestres + ["Final"], key="bimestre")
 
@@ -259,13 +481,32 @@ if serie_selecionada:
         if st.button("Consultar"):
             if not matricula_input:
                 st.error("Por favor, digite a matrícula.")
-            elif validate_matricula(nome_selecionado, matricula_input, alunos_serie):
-                resultado = df[
-                    (df['Nome do Aluno'].str.upper() == nome_selecionado.upper()) &
-                    (df['Matrícula'].astype(str).str.strip() == matricula_input.strip()) &
-                    (df['Série'] == serie_selecionada) &
-                    (df['Bimestre'] == bimestre)
-                ]
+            elif validate_matricula(nome_selecionado, matricula_input, get_matricula_set(df)):
+                def filtrar_aluno(dados):
+                    return dados[
+                        (dados['Nome do Aluno'] == nome_selecionado) &
+                        (dados['Matrícula'] == matricula_input.strip().upper()) &
+                        (dados['Série'] == serie_selecionada) &
+                        (dados['Bimestre'] == bimestre)
+                    ]
+
+                resultado = filtrar_aluno(df)
+                # Relê só as linhas do aluno para exibir as notas mais recentes
+                try:
+                    spreadsheet = st.session_state["spreadsheet"]
+                    atualizado = filtrar_aluno(fetch_student_rows(
+                        spreadsheet, df, resultado['row_index'], get_notas_row_count(spreadsheet)))
+                    # Linhas apagadas ou reordenadas desde a última carga deixam
+                    # de casar com o filtro: completa com as da cópia em memória
+                    resultado = pd.concat([atualizado, resultado]).drop_duplicates(
+                        subset=['Componente Curricular', 'Tipo de Avaliação'], keep='first')
+                except Exception:
+                    logger.exception(
+                        "Falha ao reler as linhas do aluno na planilha")
+                    st.warning(
+                        "Não foi possível atualizar as notas; exibindo a última versão carregada.")
+                resultado = resultado.drop(
+                    columns='row_index', errors='ignore')
                 if not resultado.empty:
                     display_boletim(resultado)
                     st.session_state["consultado"] = True
@@ -1,12 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 import os
 import re
 import json
+import tempfile
 import traceback
+import random
+import time
 
 # Constantes
 SCOPE = [
@@ -16,10 +21,43 @@ SCOPE = [
 SHEET_NAME = "Boletins"
 WORKSHEET_NOTAS = "Notas_Tabela"
 WORKSHEET_CONTROLE = "Controle_Liberacao"
+# Colunas que identificam unicamente uma nota lançada
+CHAVE_NOTA = ['Matrícula', 'Série', 'Componente Curricular',
+              'Bimestre', 'Tipo de Avaliação']
+# Colunas de Notas_Tabela usadas pelo app; A:J é o layout gravado em nova_linha
+COLUNAS_NOTAS = ['Nome do Aluno', 'Matrícula', 'Série', 'Turno', 'Componente Curricular',
+                 'Bimestre', 'Tipo de Avaliação', 'Nota', 'Mat_Professor']
+ULTIMA_COLUNA_NOTAS = "J"
+# Cópia local (Parquet) dos dados já normalizados; cada app normaliza de um jeito,
+# então cada um usa o próprio subdiretório
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache",
+                         os.path.splitext(os.path.basename(__file__))[0])
+
+# Padrões usados na limpeza das notas
+DATE_RE = re.compile(r'^\d{1,2}/\d{1,2}$')
+NON_NUMERIC_RE = re.compile(r'[^\d.]')
 
 # Funções auxiliares
 
 
+def show_error(message):
+    """Exibe o erro; o traceback completo só aparece com DEBUG ativo na sessão."""
+    if st.session_state.get("DEBUG"):
+        message = f"{message}\n{traceback.format_exc()}"
+    st.error(message)
+
+
+def with_retry(fn, *args, retries=5, base=0.5, statuses=(429, 500, 503), **kwargs):
+    """Chama a API do Google repetindo com backoff exponencial em erros de cota ou do servidor."""
+    for tentativa in range(retries):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in statuses or tentativa == retries - 1:
+                raise
+            time.sleep(base * 2 ** tentativa + random.random() * 0.1)
+
+
 def authenticate_gsheets():
     """Autentica com Google Sheets usando credenciais JSON."""
     try:
@@ -49,67 +87,286 @@ def authenticate_gsheets():
             f"Erro ao ler o arquivo credenciais.json: Formato JSON inválido. {e}")
         st.stop()
     except Exception as e:
-        st.error(
-            f"Erro ao autenticar com Google Sheets: {e}\n{traceback.format_exc()}")
+        show_error(
+            f"Erro ao autenticar com Google Sheets: {e}")
         st.stop()
 
 
-def clean_nota_value(value):
-    """Converte valores de nota, tratando vírgulas, datas e outros formatos."""
-    if pd.isna(value):
-        return 0.0
-    value = str(value).strip()
-    value = value.replace(',', '.')
-    if re.match(r'^\d{1,2}/\d{1,2}$', value):
-        try:
-            parts = value.split('/')
-            value = f"{parts[0]}.{parts[1]}"
-        except:
-            return 0.0
-    value = re.sub(r'[^\d.]', '', value)
-    parts = value.split('.')
-    if len(parts) > 2:
-        value = parts[0] + '.' + ''.join(parts[1:])
-    try:
-        return float(value) if value else 0.0
-    except ValueError:
-        return 0.0
+def clean_nota_series(notas):
+    """Converte uma coluna de notas, tratando vírgulas, datas e outros formatos."""
+    s = notas.astype(str).str.strip().str.replace(',', '.', regex=False)
+    date_mask = s.str.fullmatch(DATE_RE)
+    s = s.mask(date_mask, s.str.replace('/', '.', regex=False))
+    s = s.str.replace(NON_NUMERIC_RE, '', regex=True)
+    # Mantém apenas o primeiro ponto decimal
+    partes = s.str.partition('.')
+    s = partes[0] + partes[1] + partes[2].str.replace('.', '', regex=False)
+    return pd.to_numeric(s, errors='coerce').fillna(0.0)
+
+
+def rows_to_dataframe(rows):
+    """Monta um DataFrame a partir das linhas da planilha (cabeçalho na primeira linha)."""
+    if not rows:
+        return pd.DataFrame()
+    # Cabeçalhos vazios ou repetidos recebem nomes únicos
+    headers = []
+    vistos = {}
+    for i, col in enumerate(rows[0]):
+        col = col or f"Coluna_{i + 1}"
+        if col in vistos:
+            vistos[col] += 1
+            col = f"{col}_{vistos[col]}"
+        else:
+            vistos[col] = 1
+        headers.append(col)
+    # A API de valores omite células vazias no fim da linha (inclusive no
+    # cabeçalho); ajusta cada linha exatamente à largura do cabeçalho
+    largura = len(headers)
+    linhas = [(list(row) + [''] * largura)[:largura] for row in rows[1:]]
+    return pd.DataFrame(linhas, columns=headers)
+
+
+def prepare_data(rows, colunas=None):
+    """Monta e normaliza o DataFrame a partir das linhas lidas da planilha.
+
+    Se colunas for informado, mantém apenas as que existirem na planilha.
+    """
+    data = rows_to_dataframe(rows)
+    headers = rows[0] if rows else []
+    if colunas is not None:
+        data = data[[col for col in colunas if col in data.columns]].copy()
+    # Normalizar colunas de texto
+    for col in ['Matrícula', 'Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
+        if col in data.columns:
+            data[col] = data[col].astype(str).str.strip().str.upper()
+    # Converte a coluna 'Nota'
+    if 'Nota' in data.columns:
+        data['Nota'] = clean_nota_series(data['Nota'])
+    # Adiciona índice da linha (1-based, considerando cabeçalho)
+    data['row_index'] = data.index + 2
+    return data, headers, build_lookup(data)
+
+
+def build_lookup(data):
+    """Indexa (chave da nota) -> (nota, linha), mantendo a primeira ocorrência."""
+    if not all(col in data.columns for col in CHAVE_NOTA + ['Nota']):
+        return {}
+    unicos = data.drop_duplicates(subset=CHAVE_NOTA)
+    return dict(zip(
+        zip(*(unicos[col] for col in CHAVE_NOTA)),
+        zip(unicos['Nota'], unicos['row_index'])
+    ))
 
 
 @st.cache_data(show_spinner=False, ttl=300)
-def load_data(worksheet_name, _cache_version=0):
-    """Carrega dados de uma planilha como DataFrame."""
+def get_sheet_revision():
+    """Retorna a data da última alteração da planilha no Drive (None se indisponível)."""
     try:
         client = st.session_state["client"]
-        sheet = client.open(SHEET_NAME).worksheet(worksheet_name)
-        data = pd.DataFrame(sheet.get_all_records())
-        headers = sheet.row_values(1)
-        # Normalizar colunas de texto
-        for col in ['Matrícula', 'Série', 'Componente Curricular', 'Bimestre', 'Tipo de Avaliação', 'Mat_Professor']:
-            if col in data.columns:
-                data[col] = data[col].astype(str).str.strip().str.upper()
-        # Converte a coluna 'Nota'
-        if 'Nota' in data.columns:
-            data['Nota'] = data['Nota'].apply(clean_nota_value)
-            data['Nota'] = pd.to_numeric(
-                data['Nota'], errors='coerce').fillna(0.0)
-        # Adiciona índice da linha (1-based, considerando cabeçalho)
-        data['row_index'] = data.index + 2
-        return data, sheet, headers
+        spreadsheet = st.session_state["spreadsheet"]
+        resp = client.request(
+            "get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet.id}",
+            params={"fields": "modifiedTime", "supportsAllDrives": True})
+        return resp.json().get("modifiedTime")
+    except Exception:
+        return None
+
+
+def read_parquet_cache(name, revision):
+    """Lê a cópia local (dados e cabeçalhos) se ela corresponde à revisão da planilha."""
+    if revision is None:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, f"{name}.meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("revision") != revision:
+            return None
+        return pd.read_parquet(os.path.join(CACHE_DIR, f"{name}.parquet")), meta["headers"]
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+
+def replace_file(path, write):
+    """Grava via write(caminho_temporario) e move o resultado para path de uma só vez."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def write_parquet_cache(name, revision, data, headers):
+    """Salva a cópia local dos dados associada à revisão da planilha."""
+    if revision is None:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Parquet primeiro e metadados por último: um leitor concorrente nunca
+        # vê a revisão nova apontando para um arquivo incompleto
+        replace_file(os.path.join(CACHE_DIR, f"{name}.parquet"),
+                     lambda tmp: data.to_parquet(tmp, index=False))
+
+        def write_meta(tmp):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"revision": revision, "headers": headers}, f)
+
+        replace_file(os.path.join(CACHE_DIR, f"{name}.meta.json"), write_meta)
+    except (OSError, ValueError, ImportError):
+        pass
+
+
+def open_spreadsheet(client):
+    """Abre a planilha principal uma única vez."""
+    try:
+        return client.open(SHEET_NAME)
+    except gspread.exceptions.SpreadsheetNotFound:
+        st.error(f"Planilha {SHEET_NAME} não encontrada.")
+        st.stop()
+    except Exception as e:
+        show_error(
+            f"Erro ao abrir planilha {SHEET_NAME}: {e}")
+        st.stop()
+
+
+def load_data(worksheet_name, ultima_coluna=None, colunas=None):
+    """Carrega dados de uma planilha como DataFrame, opcionalmente só até ultima_coluna."""
+    try:
+        sheet = with_retry(
+            st.session_state["spreadsheet"].worksheet, worksheet_name)
+        if ultima_coluna is None:
+            rows = with_retry(sheet.get_all_values)
+        else:
+            rows = with_retry(sheet.get, f"A1:{ultima_coluna}")
+        return prepare_data(rows, colunas)
     except gspread.exceptions.WorksheetNotFound:
         st.error(f"Planilha {worksheet_name} não encontrada.")
-        return pd.DataFrame(), None, []
+        return pd.DataFrame(), [], {}
     except Exception as e:
-        st.error(
-            f"Erro ao carregar planilha {worksheet_name}: {e}\n{traceback.format_exc()}")
+        show_error(
+            f"Erro ao carregar planilha {worksheet_name}: {e}")
+        st.stop()
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def load_all_worksheets(revision=None):
+    """Carrega as planilhas de notas e de controle em uma única requisição.
+
+    Se a planilha não mudou desde a última leitura, usa a cópia local em Parquet.
+    """
+    cached = [read_parquet_cache(name, revision)
+              for name in (WORKSHEET_NOTAS, WORKSHEET_CONTROLE)]
+    if all(c is not None for c in cached):
+        return tuple((data, headers, build_lookup(data)) for data, headers in cached)
+    try:
+        spreadsheet = st.session_state["spreadsheet"]
+        resp = with_retry(spreadsheet.values_batch_get,
+                          [f"{WORKSHEET_NOTAS}!A1:{ULTIMA_COLUNA_NOTAS}", WORKSHEET_CONTROLE])
+        value_ranges = resp.get('valueRanges', [])
+        notas = prepare_data(
+            value_ranges[0].get('values', []), COLUNAS_NOTAS)
+        controle = prepare_data(value_ranges[1].get('values', []))
+        write_parquet_cache(WORKSHEET_NOTAS, revision, notas[0], notas[1])
+        write_parquet_cache(WORKSHEET_CONTROLE, revision,
+                            controle[0], controle[1])
+        return notas, controle
+    except Exception as e:
+        show_error(
+            f"Erro ao carregar planilhas {WORKSHEET_NOTAS} e {WORKSHEET_CONTROLE}: {e}")
         st.stop()
 
 
+def get_notas_sheet_id():
+    """Id da aba de notas, buscado uma única vez por sessão."""
+    if "notas_sheet_id" not in st.session_state:
+        st.session_state["notas_sheet_id"] = with_retry(
+            st.session_state["spreadsheet"].worksheet, WORKSHEET_NOTAS).id
+    return st.session_state["notas_sheet_id"]
+
+
+def cell_data(valor):
+    """Converte um valor em CellData da API do Sheets."""
+    if isinstance(valor, (int, float)):
+        return {"userEnteredValue": {"numberValue": valor}}
+    return {"userEnteredValue": {"stringValue": str(valor)}}
+
+
+def batch_write(atualizacoes, novas_linhas, nota_column_idx):
+    """Grava as alterações e inclui as novas linhas em um único spreadsheets.batchUpdate.
+
+    atualizacoes é uma lista de (linha, nota) para notas já existentes; as novas
+    linhas são anexadas pelo próprio Sheets ao fim da tabela (appendCells), sem
+    depender de posições calculadas a partir do df em cache.
+    """
+    sheet_id = get_notas_sheet_id()
+    requests = [{
+        "updateCells": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": linha - 1, "endRowIndex": linha,
+                "startColumnIndex": nota_column_idx - 1, "endColumnIndex": nota_column_idx
+            },
+            "rows": [{"values": [cell_data(nota)]}],
+            "fields": "userEnteredValue"
+        }
+    } for linha, nota in atualizacoes]
+    if novas_linhas:
+        requests.append({
+            "appendCells": {
+                "sheetId": sheet_id,
+                "rows": [{"values": [cell_data(v) for v in linha]} for linha in novas_linhas],
+                "fields": "userEnteredValue"
+            }
+        })
+    body = {"requests": requests}
+    # appendCells não é idempotente: só repete quando a API recusou a chamada (429)
+    try:
+        return with_retry(st.session_state["spreadsheet"].batch_update, body, statuses=(429,))
+    except gspread.exceptions.APIError as e:
+        if e.response.status_code != 401:
+            raise
+        st.session_state["client"] = authenticate_gsheets()
+        st.session_state["spreadsheet"] = open_spreadsheet(
+            st.session_state["client"])
+        return with_retry(st.session_state["spreadsheet"].batch_update, body, statuses=(429,))
+
+
+def sorted_unique(values):
+    """Valores distintos e ordenados de uma coluna, prontos para um selectbox."""
+    return np.sort(values.dropna().unique()).tolist()
+
+
+def cached_options(df, key, compute):
+    """Memoriza na sessão listas de opções derivadas de df até que df seja recarregado."""
+    cache = st.session_state.setdefault(
+        "options_cache", {"df": None, "values": {}})
+    # Guarda a referência (e não o id) para que um novo df nunca reaproveite o cache
+    if cache["df"] is not df:
+        cache["df"] = df
+        cache["values"] = {}
+    if key not in cache["values"]:
+        cache["values"][key] = compute()
+    return cache["values"][key]
+
+
+def get_alunos_by_serie(df):
+    """Alunos de cada série (sem repetição, por nome), calculados uma vez por df carregado."""
+    return cached_options(df, "alunos_by_serie", lambda: {
+        serie: sub[['Nome do Aluno', 'Matrícula', 'Turno']].drop_duplicates(
+            subset=['Matrícula']).sort_values(by='Nome do Aluno')
+        for serie, sub in df.groupby('Série')
+    })
+
+
 def validate_period(bimestre, df_periodo, today):
     """Valida se o período de lançamento está liberado."""
     bimestre = str(bimestre).strip().upper()
-    periodo_ok = df_periodo[df_periodo['Bimestre'].str.strip(
-    ).str.upper() == bimestre]
+    periodo_ok = df_periodo[df_periodo['Bimestre'] == bimestre]
     if periodo_ok.empty:
         return False, "Lançamento não autorizado para este período. Consulte o gestor."
     try:
@@ -126,13 +383,13 @@ def validate_period(bimestre, df_periodo, today):
 
 def validate_professor(mat_prof, df):
     """Verifica se a matrícula do professor é válida."""
-    return str(mat_prof).strip().upper() in df['Mat_Professor'].str.strip().str.upper().values
+    return str(mat_prof).strip().upper() in df['Mat_Professor'].values
 
 
 def logout():
     """Limpa a autenticação do professor e parâmetros."""
     for key in list(st.session_state.keys()):
-        if key not in ["client", "df", "sheet_notas", "df_periodo", "headers_notas", "cache_version"]:
+        if key not in ["client", "spreadsheet", "df", "df_periodo", "headers_notas", "df_lookup", "notas_sheet_id"]:
             del st.session_state[key]
     st.success("Deslogado com sucesso!")
     st.rerun()
@@ -141,24 +398,25 @@ def logout():
 # Inicialização
 if "client" not in st.session_state:
     st.session_state["client"] = authenticate_gsheets()
-if "cache_version" not in st.session_state:
-    st.session_state["cache_version"] = 0
+if "spreadsheet" not in st.session_state:
+    st.session_state["spreadsheet"] = open_spreadsheet(
+        st.session_state["client"])
 if "df" not in st.session_state:
-    st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"] = load_data(
-        WORKSHEET_NOTAS, _cache_version=st.session_state["cache_version"])
-    st.session_state["df_periodo"], _, _ = load_data(
-        WORKSHEET_CONTROLE, _cache_version=st.session_state["cache_version"])
+    # A revisão é verificada no Drive no máximo a cada 5 minutos
+    revision = get_sheet_revision()
+    notas, controle = load_all_worksheets(revision=revision)
+    st.session_state["df"], st.session_state["headers_notas"], st.session_state["df_lookup"] = notas
+    st.session_state["df_periodo"], _, _ = controle
 
 client = st.session_state["client"]
 df = st.session_state["df"]
-sheet_notas = st.session_state["sheet_notas"]
 df_periodo = st.session_state["df_periodo"]
 headers_notas = st.session_state["headers_notas"]
+df_lookup = st.session_state["df_lookup"]
 
 # Encontra a coluna 'Nota'
 nota_column_idx = headers_notas.index(
     "Nota") + 1 if "Nota" in headers_notas else 8
-nota_column_letter = chr(64 + nota_column_idx)
 
 # Interface
 st.title("📘 Lançamento de Notas por Professor 2025")
@@ -190,18 +448,21 @@ else:
     # 2. Parâmetros do Lançamento
     nome_prof = st.session_state["nome_prof"]
     mat_prof = st.session_state["mat_prof"]
+    # Colunas de texto já vêm normalizadas de load_data; normaliza só a entrada
+    mat_prof_n = mat_prof.strip().upper()
 
     st.subheader("2. Parâmetros do Lançamento")
-    series_disponiveis = df[df['Mat_Professor'].str.strip().str.upper(
-    ) == mat_prof.strip().upper()]['Série'].unique().tolist()
+    series_disponiveis = cached_options(df, ("series", mat_prof_n), lambda: sorted_unique(
+        df[df['Mat_Professor'] == mat_prof_n]['Série']))
     if not series_disponiveis:
         st.error("Nenhuma série associada a esta matrícula.")
         st.stop()
 
     serie = st.selectbox(
         "Série", options=[""] + series_disponiveis, index=0, key="serie")
-    componentes = df[(df['Mat_Professor'].str.strip().str.upper() == mat_prof.strip()) &
-                     (df['Série'].str.strip().str.upper() == str(serie).strip().upper())]['Componente Curricular'].unique() if serie else []
+    serie_norm = str(serie).strip().upper()
+    componentes = cached_options(df, ("componentes", mat_prof_n, serie_norm), lambda: sorted_unique(
+        df[(df['Mat_Professor'] == mat_prof_n) & (df['Série'] == serie_norm)]['Componente Curricular'])) if serie else []
     componente = st.selectbox("Componente Curricular", options=[
                               ""] + list(componentes) if len(componentes) > 0 else [""], index=0, key="componente")
     bimestre = st.selectbox(
@@ -225,8 +486,8 @@ else:
         st.stop()
 
     # Carrega alunos
-    alunos_serie = df[(df['Série'].str.strip().str.upper() == str(serie).strip().upper())][
-        ['Nome do Aluno', 'Matrícula', 'Turno']].drop_duplicates(subset=['Matrícula']).sort_values(by='Nome do Aluno')
+    alunos_serie = get_alunos_by_serie(df).get(
+        serie_norm, pd.DataFrame(columns=['Nome do Aluno', 'Matrícula', 'Turno']))
 
     if alunos_serie.empty:
         st.warning("Nenhum aluno encontrado para esta série.")
@@ -234,36 +495,31 @@ else:
 
     # 3. Lançamento de Notas
     st.subheader("3. Lançamento de Notas")
-    with st.form("form_lote_notas"):
-        notas = {}
-        for idx, row in alunos_serie.iterrows():
-            nome = row['Nome do Aluno']
-            matricula = row['Matrícula']
-            col_id = f"nota_{matricula}_{serie}_{componente}_{bimestre}_{tipo_avaliacao}_{idx}"
-
-            # Normalizar valores para o filtro
-            matricula_norm = str(matricula).strip().upper()
-            serie_norm = str(serie).strip().upper()
-            componente_norm = str(componente).strip().upper()
-            bimestre_norm = str(bimestre).strip().upper()
-            tipo_avaliacao_norm = str(tipo_avaliacao).strip().upper()
-
-            # Busca nota existente
-            cond = (
-                (df['Matrícula'].str.strip().str.upper() == matricula_norm) &
-                (df['Série'].str.strip().str.upper() == serie_norm) &
-                (df['Componente Curricular'].str.strip().str.upper() == componente_norm) &
-                (df['Bimestre'].str.strip().str.upper() == bimestre_norm) &
-                (df['Tipo de Avaliação'].str.strip(
-                ).str.upper() == tipo_avaliacao_norm)
-            )
-            nota_existente = float(
-                df[cond]['Nota'].values[0]) if not df[cond].empty else 0.0
+    # Normalizar parâmetros uma única vez (colunas já normalizadas em load_data)
+    componente_norm = str(componente).strip().upper()
+    bimestre_norm = str(bimestre).strip().upper()
+    tipo_avaliacao_norm = str(tipo_avaliacao).strip().upper()
+
+    # Busca notas existentes
+    existentes = {
+        idx: df_lookup.get((matricula, serie_norm, componente_norm,
+                           bimestre_norm, tipo_avaliacao_norm))
+        for idx, matricula in alunos_serie['Matrícula'].items()
+    }
+    edit_df = alunos_serie[['Nome do Aluno', 'Matrícula']].assign(
+        Nota=[float(existentes[idx][0]) if existentes[idx] else 0.0 for idx in alunos_serie.index])
 
-            cols = st.columns([3, 1])
-            cols[0].markdown(f"**{nome} ({matricula})**")
-            notas[matricula] = cols[1].number_input(
-                "", min_value=0.0, max_value=10.0, step=0.1, value=nota_existente, key=col_id)
+    with st.form("form_lote_notas"):
+        edited = st.data_editor(
+            edit_df,
+            column_config={
+                "Nota": st.column_config.NumberColumn(
+                    min_value=0.0, max_value=10.0, step=0.1, format="%.2f")
+            },
+            disabled=['Nome do Aluno', 'Matrícula'],
+            hide_index=True,
+            use_container_width=True,
+            key=f"notas_{serie}_{componente}_{bimestre}_{tipo_avaliacao}")
 
         sobrescrever = st.checkbox(
             "🔁 Sobrescrever notas existentes", key="sobrescrever")
@@ -274,49 +530,32 @@ else:
                 registros = []
                 erros = []
                 atualizados = []
-                batch_updates = []
+                atualizacoes = []
 
-                for _, row in alunos_serie.iterrows():
+                # Apenas as linhas cuja nota foi alterada no editor; célula
+                # apagada conta como não alterada (não zera nota existente)
+                notas_editadas = edited['Nota'].fillna(edit_df['Nota'])
+                alterados = notas_editadas.index[notas_editadas != edit_df['Nota']]
+
+                for idx in alterados:
+                    row = alunos_serie.loc[idx]
                     nome = row['Nome do Aluno']
                     matricula = row['Matrícula']
                     turno = row['Turno']
-                    nota_valor = notas[matricula]
-
-                    # Normalizar valores para o filtro
-                    matricula_norm = str(matricula).strip().upper()
-                    serie_norm = str(serie).strip().upper()
-                    componente_norm = str(componente).strip().upper()
-                    bimestre_norm = str(bimestre).strip().upper()
-                    tipo_avaliacao_norm = str(tipo_avaliacao).strip().upper()
-
-                    # Busca nota existente
-                    cond = (
-                        (df['Matrícula'].str.strip().str.upper() == matricula_norm) &
-                        (df['Série'].str.strip().str.upper() == serie_norm) &
-                        (df['Componente Curricular'].str.strip().str.upper() == componente_norm) &
-                        (df['Bimestre'].str.strip().str.upper() == bimestre_norm) &
-                        (df['Tipo de Avaliação'].str.strip().str.upper() == tipo_avaliacao_norm)
-                    )
-                    nota_existente = float(df[cond]['Nota'].values[0]) if not df[cond].empty else 0.0
-
-                    # Ignorar se a nota não foi alterada
-                    if nota_valor == nota_existente or (nota_valor == 0.0 and nota_existente == 0.0):
-                        continue
+                    nota_valor = float(notas_editadas[idx])
+                    existente = existentes[idx]
 
                     nova_linha = [
                         nome, matricula, serie, turno, componente,
-                        bimestre, tipo_avaliacao, f"{nota_valor:.2f}", nome_prof, mat_prof
+                        bimestre, tipo_avaliacao, round(nota_valor, 2), nome_prof, mat_prof
                     ]
 
-                    existe = df[cond]
-                    if not existe.empty:
+                    if existente:
                         if sobrescrever:
                             try:
-                                row_idx = existe['row_index'].values[0]
-                                batch_updates.append({
-                                    "range": f"{nota_column_letter}{row_idx}",
-                                    "values": [[f"{nota_valor:.2f}"]]
-                                })
+                                row_idx = existente[1]
+                                atualizacoes.append(
+                                    (int(row_idx), round(nota_valor, 2)))
                                 atualizados.append(
                                     f"Nota atualizada para {nome} ({matricula}): {nota_valor:.2f}")
                             except Exception as e:
@@ -327,34 +566,16 @@ else:
                     else:
                         registros.append(nova_linha)
 
-                # Reinicializar o cliente antes de atualizar
-                try:
-                    client = authenticate_gsheets()
-                    st.session_state["client"] = client
-                    sheet_notas = client.open(SHEET_NAME).worksheet(WORKSHEET_NOTAS)
-                    st.session_state["sheet_notas"] = sheet_notas
-                except Exception as e:
-                    st.error(f"Erro ao reinicializar autenticação: {e}\n{traceback.format_exc()}")
-                    st.stop()
-
-                # Executar atualizações em lote
-                if batch_updates:
+                # Executar atualizações e inclusões em uma única requisição
+                if atualizacoes or registros:
                     try:
-                        sheet_notas.batch_update(batch_updates)
+                        batch_write(atualizacoes, registros, nota_column_idx)
                         for msg in atualizados:
                             st.success(msg)
-                    except Exception as e:
-                        st.error(f"Erro ao atualizar notas em lote: {e}\n{traceback.format_exc()}")
-                        st.stop()
-
-                # Adicionar novos registros
-                if registros:
-                    try:
-                        sheet_notas.append_rows(registros, value_input_option="USER_ENTERED")
                         for reg in registros:
-                            st.success(f"Nota lançada para {reg[0]} ({reg[1]}): {reg[7]}")
+                            st.success(f"Nota lançada para {reg[0]} ({reg[1]}): {reg[7]:.2f}")
                     except Exception as e:
-                        st.error(f"Erro ao adicionar novas notas: {e}\n{traceback.format_exc()}")
+                        show_error(f"Erro ao salvar notas: {e}")
                         st.stop()
 
                 # Exibir erros, se houver
@@ -365,8 +586,11 @@ else:
                 if not atualizados and not registros:
                     st.info("Nenhuma nota foi alterada ou adicionada.")
                 else:
-                    # Atualizar cache
-                    st.session_state["cache_version"] += 1
-                    st.session_state["df"], st.session_state["sheet_notas"], st.session_state["headers_notas"] = load_data(
-                        WORKSHEET_NOTAS, _cache_version=st.session_state["cache_version"])
+                    # Reler a planilha sem cache e descartar a revisão
+                    # memorizada, para que novas sessões não carreguem dados
+                    # anteriores à gravação
+                    get_sheet_revision.clear()
+                    st.session_state["df"], st.session_state["headers_notas"], st.session_state["df_lookup"] = load_data(
+                        WORKSHEET_NOTAS, ultima_coluna=ULTIMA_COLUNA_NOTAS,
+                        colunas=COLUNAS_NOTAS)
                     st.success("Notas processadas com sucesso!")
\ No newline at end of file